@@ -1,105 +1,334 @@
-import json
-import os
-from typing import Dict, List, Optional
-from models import AccountRecord, UserSession
-from datetime import datetime, timedelta
-
-DATA_FILE = "data.json"
-SESSIONS_FILE = "sessions.json"
-
-
-class Database:
-    def __init__(self):
-        self.accounts: List[Dict] = []
-        self.sessions: Dict[str, UserSession] = {}
-        self.load_data()
-
-    def load_data(self):
-        # 加载账户数据
-        if os.path.exists(DATA_FILE):
-            try:
-                with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.accounts = data.get('accounts', [])
-            except:
-                self.accounts = []
-
-        # 加载会话数据
-        if os.path.exists(SESSIONS_FILE):
-            try:
-                with open(SESSIONS_FILE, 'r', encoding='utf-8') as f:
-                    sessions_data = json.load(f)
-                    self.sessions = {}
-                    for session_id, session_data in sessions_data.items():
-                        # 检查会话是否过期（24小时）
-                        login_time = datetime.fromisoformat(session_data['login_time'])
-                        if datetime.now() - login_time < timedelta(hours=24):
-                            self.sessions[session_id] = UserSession(**session_data)
-            except:
-                self.sessions = {}
-
-    def save_data(self):
-        # 保存账户数据
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump({'accounts': self.accounts}, f, ensure_ascii=False, indent=2)
-
-        # 保存会话数据
-        sessions_data = {}
-        for session_id, session in self.sessions.items():
-            sessions_data[session_id] = session.dict()
-
-        with open(SESSIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(sessions_data, f, ensure_ascii=False, indent=2)
-
-    def get_all_accounts(self) -> List[Dict]:
-        accounts = self.accounts.copy()
-        # 计算每个账户的剩余金额（整数计算）
-        for account in accounts:
-            total_paid = sum(account['paid_amounts'])
-            account['remaining_amount'] = account['total_amount'] - total_paid
-        return accounts
-
-    def add_account(self, account: AccountRecord):
-        account_dict = account.dict()
-        self.accounts.append(account_dict)
-        self.save_data()
-
-    def update_account(self, index: int, account_data: Dict):
-        if 0 <= index < len(self.accounts):
-            self.accounts[index] = account_data
-            self.save_data()
-
-    def delete_account(self, index: int):
-        if 0 <= index < len(self.accounts):
-            self.accounts.pop(index)
-            self.save_data()
-
-    def add_paid_amount(self, index: int, amount: int):
-        if 0 <= index < len(self.accounts):
-            self.accounts[index]['paid_amounts'].append(amount)
-            self.save_data()
-
-    def toggle_lock(self, index: int, locked: bool):
-        if 0 <= index < len(self.accounts):
-            self.accounts[index]['locked'] = locked
-            self.save_data()
-
-    def cleanup_expired_sessions(self):
-        """清理过期会话"""
-        current_time = datetime.now()
-        expired_sessions = []
-
-        for session_id, session in self.sessions.items():
-            login_time = datetime.fromisoformat(session.login_time)
-            if current_time - login_time >= timedelta(hours=24):
-                expired_sessions.append(session_id)
-
-        for session_id in expired_sessions:
-            del self.sessions[session_id]
-
-        if expired_sessions:
-            self.save_data()
-
-
-# 全局数据库实例
-db = Database()
\ No newline at end of file
+import asyncio
+import heapq
+import os
+import sqlite3
+import threading
+import time
+
+import msgpack
+import orjson
+from typing import Dict, List, Optional
+from models import AccountRecord, UserSession
+from datetime import datetime
+
+DATA_FILE = "data.json"
+DB_FILE = "data.db"
+# 会话数据没人手工改，用二进制msgpack；data.json保持可读（仅作首次导入源）
+SESSIONS_FILE = "sessions.msgpack"
+LEGACY_SESSIONS_FILE = "sessions.json"
+SESSION_TTL = 24 * 60 * 60  # 会话有效期24小时（秒）
+
+
+class Database:
+    def __init__(self):
+        self.sessions: Dict[str, UserSession] = {}
+        # login_time只在建会话时处理一次，之后过期判断直接查这个表
+        self.session_expiry: Dict[str, int] = {}
+        # 按过期时间排的小根堆，清理时只弹真正到期的会话
+        self._expiry_heap: List[tuple] = []
+        self._last_cleanup = 0.0
+        # 写盘防抖：标脏后由后台任务合并落盘，避免每次变更都同步写文件
+        self._dirty = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._write_lock = threading.Lock()
+        # 复用发给模板的“账户视图”列表，减少每个请求的小对象分配
+        self._view_pool: List[List[Dict]] = []
+        # 账户数据存SQLite（WAL模式），每次变更只写相关页，不再整文件重写
+        self.conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        self._migrate_from_json()
+        self.load_data()
+
+    def _create_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS accounts (
+                id INTEGER PRIMARY KEY,
+                account_code TEXT NOT NULL,
+                account_name TEXT NOT NULL,
+                total_amount INTEGER NOT NULL,
+                manager TEXT NOT NULL,
+                created_time TEXT NOT NULL,
+                locked INTEGER NOT NULL DEFAULT 0,
+                remaining_amount INTEGER NOT NULL DEFAULT 0,
+                paid_total INTEGER NOT NULL DEFAULT 0,
+                payment_count INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS payments (
+                account_id INTEGER NOT NULL,
+                amount INTEGER NOT NULL,
+                seq INTEGER NOT NULL
+            )
+        """)
+        # 旧库补上remaining_amount列并回填
+        columns = [row['name'] for row in self.conn.execute("PRAGMA table_info(accounts)")]
+        if 'remaining_amount' not in columns:
+            self.conn.execute("ALTER TABLE accounts ADD COLUMN remaining_amount INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute(
+                "UPDATE accounts SET remaining_amount = total_amount - "
+                "COALESCE((SELECT SUM(amount) FROM payments WHERE account_id = accounts.id), 0)"
+            )
+        # 旧库补上累计已出/笔数列并回填
+        if 'paid_total' not in columns:
+            self.conn.execute("ALTER TABLE accounts ADD COLUMN paid_total INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute("ALTER TABLE accounts ADD COLUMN payment_count INTEGER NOT NULL DEFAULT 0")
+            self.conn.execute(
+                "UPDATE accounts SET "
+                "paid_total = COALESCE((SELECT SUM(amount) FROM payments WHERE account_id = accounts.id), 0), "
+                "payment_count = COALESCE((SELECT COUNT(*) FROM payments WHERE account_id = accounts.id), 0)"
+            )
+        self.conn.commit()
+
+    def _migrate_from_json(self):
+        """首次启动时把旧的data.json数据导入SQLite"""
+        if not os.path.exists(DATA_FILE):
+            return
+
+        # 先拿写锁再查空表，多个进程同时首启时只有一个能导入
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.conn.execute("SELECT COUNT(*) FROM accounts").fetchone()[0] > 0:
+                self.conn.rollback()
+                return
+
+            try:
+                with open(DATA_FILE, 'rb') as f:
+                    data = orjson.loads(f.read())
+                    accounts = data.get('accounts', [])
+            except:
+                accounts = []
+
+            for account in accounts:
+                paid_amounts = account.get('paid_amounts', [])
+                cursor = self.conn.execute(
+                    "INSERT INTO accounts (account_code, account_name, total_amount, manager, created_time, locked, "
+                    "remaining_amount, paid_total, payment_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (account['account_code'], account['account_name'], account['total_amount'],
+                     account['manager'], account['created_time'], int(account.get('locked', False)),
+                     account['total_amount'] - sum(paid_amounts), sum(paid_amounts), len(paid_amounts))
+                )
+                for seq, amount in enumerate(paid_amounts, start=1):
+                    self.conn.execute(
+                        "INSERT INTO payments (account_id, amount, seq) VALUES (?, ?, ?)",
+                        (cursor.lastrowid, amount, seq)
+                    )
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
+
+    def load_data(self):
+        # 加载会话数据（兼容旧的sessions.json）
+        sessions_data = None
+        if os.path.exists(SESSIONS_FILE):
+            try:
+                with open(SESSIONS_FILE, 'rb') as f:
+                    sessions_data = msgpack.unpackb(f.read())
+            except:
+                sessions_data = None
+        elif os.path.exists(LEGACY_SESSIONS_FILE):
+            try:
+                with open(LEGACY_SESSIONS_FILE, 'rb') as f:
+                    sessions_data = orjson.loads(f.read())
+            except:
+                sessions_data = None
+
+        if sessions_data is not None:
+            try:
+                self.sessions = {}
+                now = int(time.time())
+                for session_id, session_data in sessions_data.items():
+                    # 旧格式里login_time是ISO字符串，转成时间戳
+                    login_time = session_data['login_time']
+                    if isinstance(login_time, str):
+                        login_time = int(datetime.fromisoformat(login_time).timestamp())
+                        session_data['login_time'] = login_time
+                    # 检查会话是否过期（24小时）
+                    if now - login_time < SESSION_TTL:
+                        self.sessions[session_id] = UserSession.from_dict(session_data)
+                        expires = login_time + SESSION_TTL
+                        self.session_expiry[session_id] = expires
+                        heapq.heappush(self._expiry_heap, (expires, session_id))
+            except:
+                self.sessions = {}
+                self.session_expiry = {}
+                self._expiry_heap = []
+
+    def save_sessions(self):
+        # 只有会话数据需要整文件落盘（账户走SQLite逐行写）
+        # 标脏，由后台任务500ms内合并写盘；无后台任务时（脚本、启动前）直接写
+        if self._flush_task is not None and not self._flush_task.done():
+            self._dirty.set()
+        else:
+            self.flush()
+
+    def flush(self):
+        # 同步落盘（关停钩子和无后台任务时用）
+        self._write_sessions(self._snapshot_sessions())
+
+    def _snapshot_sessions(self) -> Dict[str, dict]:
+        # 快照必须在事件循环线程里做，self.sessions只会被协程改
+        return {
+            session_id: session.to_dict()
+            for session_id, session in self.sessions.items()
+        }
+
+    def _write_sessions(self, sessions_data: Dict[str, dict]):
+        # 保存会话数据（账户数据由SQLite即时落盘，不需要整文件重写）
+        # 加锁防止后台线程和关停钩子同时写.tmp；
+        # 先写临时文件再原子替换，进程中途挂掉也不会留下半截文件
+        with self._write_lock:
+            tmp_file = SESSIONS_FILE + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(msgpack.packb(sessions_data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, SESSIONS_FILE)
+
+    def start_flusher(self):
+        """应用启动后开启写盘防抖任务"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await self._dirty.wait()
+            await asyncio.sleep(0.5)
+            self._dirty.clear()
+            # 在事件循环里先做快照（此时没人并发改dict），
+            # 线程里只做带fsync的文件写，别卡事件循环
+            sessions_data = self._snapshot_sessions()
+            await asyncio.to_thread(self._write_sessions, sessions_data)
+
+    def acquire_view(self) -> List[Dict]:
+        """取一个池化的视图列表，用完通过release_view归还"""
+        return self._view_pool.pop() if self._view_pool else []
+
+    def release_view(self, view: List[Dict]):
+        view.clear()
+        self._view_pool.append(view)
+
+    def get_all_accounts(self, view: Optional[List[Dict]] = None) -> List[Dict]:
+        paid: Dict[int, List[int]] = {}
+        for row in self.conn.execute("SELECT account_id, amount FROM payments ORDER BY account_id, seq"):
+            paid.setdefault(row['account_id'], []).append(row['amount'])
+
+        accounts = [] if view is None else view
+        for row in self.conn.execute("SELECT * FROM accounts ORDER BY id"):
+            account = dict(row)
+            account['locked'] = bool(account['locked'])
+            # 剩余金额在变更时增量维护，读取不再重新求和
+            account['paid_amounts'] = paid.get(account['id'], [])
+            accounts.append(account)
+        return accounts
+
+    def add_account(self, account: AccountRecord):
+        # 带初始出账记录的账户和导入时一样落明细，保证剩余=总额-已出恒成立
+        paid_amounts = account.paid_amounts
+        cursor = self.conn.execute(
+            "INSERT INTO accounts (account_code, account_name, total_amount, manager, created_time, locked, "
+            "remaining_amount, paid_total, payment_count) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (account.account_code, account.account_name, account.total_amount,
+             account.manager, account.created_time, int(account.locked),
+             account.total_amount - sum(paid_amounts), sum(paid_amounts), len(paid_amounts))
+        )
+        for seq, amount in enumerate(paid_amounts, start=1):
+            self.conn.execute(
+                "INSERT INTO payments (account_id, amount, seq) VALUES (?, ?, ?)",
+                (cursor.lastrowid, amount, seq)
+            )
+        self.conn.commit()
+
+    def get_account(self, account_id: int) -> Optional[Dict]:
+        """单行取账户，变更路径用它就不必构整个账户视图"""
+        row = self.conn.execute(
+            "SELECT * FROM accounts WHERE id=?", (account_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        account = dict(row)
+        account['locked'] = bool(account['locked'])
+        return account
+
+    def has_account(self, account_id: int) -> bool:
+        return self.conn.execute(
+            "SELECT 1 FROM accounts WHERE id=?", (account_id,)
+        ).fetchone() is not None
+
+    def update_account(self, account_id: int, account_data: Dict):
+        if self.has_account(account_id):
+            self.conn.execute(
+                "UPDATE accounts SET account_code=?, account_name=?, "
+                "remaining_amount = remaining_amount + (? - total_amount), total_amount=?, "
+                "manager=?, created_time=?, locked=? WHERE id=?",
+                (account_data['account_code'], account_data['account_name'],
+                 account_data['total_amount'], account_data['total_amount'],
+                 account_data['manager'], account_data['created_time'], int(account_data.get('locked', False)),
+                 account_id)
+            )
+            self.conn.commit()
+
+    def delete_account(self, account_id: int):
+        if self.has_account(account_id):
+            self.conn.execute("DELETE FROM payments WHERE account_id=?", (account_id,))
+            self.conn.execute("DELETE FROM accounts WHERE id=?", (account_id,))
+            self.conn.commit()
+
+    def add_paid_amount(self, account_id: int, amount: int):
+        if self.has_account(account_id):
+            # 累计值增量维护：剩余扣减、已出累加、笔数+1，不用扫payments表
+            self.conn.execute(
+                "UPDATE accounts SET remaining_amount = remaining_amount - ?, "
+                "paid_total = paid_total + ?, payment_count = payment_count + 1 WHERE id=?",
+                (amount, amount, account_id)
+            )
+            # 明细只追加，seq直接取刚更新的笔数
+            self.conn.execute(
+                "INSERT INTO payments (account_id, amount, seq) "
+                "VALUES (?, ?, (SELECT payment_count FROM accounts WHERE id=?))",
+                (account_id, amount, account_id)
+            )
+            self.conn.commit()
+
+    def toggle_lock(self, account_id: int, locked: bool):
+        if self.has_account(account_id):
+            self.conn.execute("UPDATE accounts SET locked=? WHERE id=?", (int(locked), account_id))
+            self.conn.commit()
+
+    def add_session(self, session_id: str, session: UserSession):
+        self.sessions[session_id] = session
+        expires = session.login_time + SESSION_TTL
+        self.session_expiry[session_id] = expires
+        heapq.heappush(self._expiry_heap, (expires, session_id))
+        self.save_sessions()
+
+    def remove_session(self, session_id: str):
+        self.sessions.pop(session_id, None)
+        self.session_expiry.pop(session_id, None)
+        self.save_sessions()
+
+    def cleanup_expired_sessions(self):
+        """清理过期会话（最多每60秒跑一次，只弹堆顶到期的）"""
+        if time.monotonic() - self._last_cleanup < 60:
+            return
+        self._last_cleanup = time.monotonic()
+        current_time = int(time.time())
+
+        removed = False
+        while self._expiry_heap and self._expiry_heap[0][0] <= current_time:
+            _, session_id = heapq.heappop(self._expiry_heap)
+            # 会话可能早已退出登录，堆里留下的旧条目直接跳过
+            if self.sessions.pop(session_id, None) is not None:
+                self.session_expiry.pop(session_id, None)
+                removed = True
+
+        if removed:
+            self.save_sessions()
+
+
+# 全局数据库实例
+db = Database()
@@ -1,57 +1,96 @@
 from fastapi import FastAPI, Request, Form, HTTPException, Cookie, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse
+import asyncio
+import time
 import uuid
-from datetime import datetime, timedelta
+
+import orjson
+from datetime import datetime
 from typing import Optional
 
 from models import AccountRecord, UserSession, ACCOUNT_MAPPING
 from database import db
 
-app = FastAPI(title="账户管理系统")
+app = FastAPI(title="账户管理系统", default_response_class=ORJSONResponse)
 
 # 模板和静态文件配置
 templates = Jinja2Templates(directory="templates")
+templates.env.auto_reload = False
+# 热路径模板只查一次，省掉每个请求的name->template查找
+INDEX_TPL = templates.env.get_template("index.html")
+LOGIN_TPL = templates.env.get_template("login.html")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 
+async def session_reaper():
+    # 每5分钟清一次过期会话，不占用请求路径
+    while True:
+        await asyncio.sleep(300)
+        db.cleanup_expired_sessions()
+
+
+@app.on_event("startup")
+async def startup():
+    # 开启会话写盘防抖任务和过期会话清理任务
+    db.start_flusher()
+    asyncio.create_task(session_reaper())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    # 退出前把未落盘的会话数据写掉
+    db.flush()
+
+
+@app.middleware("http")
+async def recycle_account_views(request: Request, call_next):
+    # 响应发出后把账户视图列表还回池里复用
+    response = await call_next(request)
+    view = getattr(request.state, "accounts_view", None)
+    if view is not None:
+        db.release_view(view)
+    return response
+
+
 def get_session(session_id: Optional[str] = None) -> Optional[UserSession]:
     if session_id and session_id in db.sessions:
-        session = db.sessions[session_id]
-        # 检查会话是否过期
-        login_time = datetime.fromisoformat(session.login_time)
-        if datetime.now() - login_time < timedelta(hours=24):
-            return session
+        # 检查会话是否过期（过期时间戳在登录时已算好）
+        if time.time() < db.session_expiry[session_id]:
+            return db.sessions[session_id]
         else:
             # 删除过期会话
-            del db.sessions[session_id]
-            db.save_data()
+            db.remove_session(session_id)
     return None
 
 
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request, session_id: Optional[str] = Cookie(None)):
-    # 清理过期会话
-    db.cleanup_expired_sessions()
-
     session = get_session(session_id)
 
     # 如果没有会话或会话过期，重定向到登录页面
     if not session:
-        response = templates.TemplateResponse("login.html", {"request": request})
+        response = HTMLResponse(LOGIN_TPL.render(request=request))
         # 清除可能存在的过期cookie
         response.delete_cookie("session_id")
         return response
 
-    accounts = db.get_all_accounts()
+    accounts = db.get_all_accounts(view=db.acquire_view())
+    request.state.accounts_view = accounts
 
-    return templates.TemplateResponse("index.html", {
-        "request": request,
-        "session": session,
+    # 预序列化账户数据，表格由前端渲染，模板开销与账户数无关
+    # （"</"转义掉，防止数据里出现</script>提前截断）
+    accounts_json = orjson.dumps({
         "accounts": accounts,
-        "account_mapping": ACCOUNT_MAPPING
-    })
+        "session": {"username": session.username, "is_viewer": session.is_viewer},
+    }).decode().replace("</", "<\\/")
+
+    return HTMLResponse(INDEX_TPL.render(
+        request=request,
+        session=session,
+        accounts_json=accounts_json
+    ))
 
 
 @app.post("/login")
@@ -59,18 +98,14 @@ async def login(request: Request, response: Response, username: str = Form(""),
     session_id = str(uuid.uuid4())
 
     if viewer_mode:
-        session = UserSession(username="浏览者", is_viewer=True, login_time=datetime.now().isoformat())
+        session = UserSession(username="浏览者", is_viewer=True, login_time=int(time.time()))
     else:
         if not username.strip():
             # 如果用户名为空，停留在登录页面并显示错误
-            return templates.TemplateResponse("login.html", {
-                "request": request,
-                "error": "请输入用户名"
-            })
-        session = UserSession(username=username.strip(), login_time=datetime.now().isoformat())
+            return HTMLResponse(LOGIN_TPL.render(request=request, error="请输入用户名"))
+        session = UserSession(username=username.strip(), login_time=int(time.time()))
 
-    db.sessions[session_id] = session
-    db.save_data()
+    db.add_session(session_id, session)
 
     redirect_response = RedirectResponse(url="/", status_code=303)
     # 设置Cookie，有效期24小时
@@ -86,8 +121,7 @@ async def login(request: Request, response: Response, username: str = Form(""),
 @app.post("/logout")
 async def logout(response: Response, session_id: Optional[str] = Cookie(None)):
     if session_id and session_id in db.sessions:
-        del db.sessions[session_id]
-        db.save_data()
+        db.remove_session(session_id)
 
     redirect_response = RedirectResponse(url="/", status_code=303)
     redirect_response.delete_cookie("session_id")
@@ -120,9 +154,16 @@ async def add_account(
     return RedirectResponse(url="/", status_code=303)
 
 
-@app.post("/add_payment/{account_index}")
+def find_account(account_id: int) -> dict:
+    account = db.get_account(account_id)
+    if account is None:
+        raise HTTPException(status_code=404, detail="账户不存在")
+    return account
+
+
+@app.post("/add_payment/{account_id}")
 async def add_payment(
-        account_index: int,
+        account_id: int,
         amount: int = Form(...),
         session_id: Optional[str] = Cookie(None)
 ):
@@ -130,78 +171,80 @@ async def add_payment(
     if not session:
         raise HTTPException(status_code=403, detail="未登录")
 
-    accounts = db.get_all_accounts()
-    if account_index < 0 or account_index >= len(accounts):
-        raise HTTPException(status_code=404, detail="账户不存在")
-
-    account = accounts[account_index]
+    account = find_account(account_id)
 
     # 检查是否被锁定
     if account['locked'] and account['manager'] != session.username:
         raise HTTPException(status_code=403, detail="账户已被锁定")
 
-    total_paid = sum(account['paid_amounts'])
-    remaining = account['total_amount'] - total_paid
-
-    if amount > remaining:
+    if amount > account['remaining_amount']:
         raise HTTPException(status_code=400, detail="支付金额超过剩余金额")
 
-    db.add_paid_amount(account_index, amount)
+    db.add_paid_amount(account_id, amount)
     return RedirectResponse(url="/", status_code=303)
 
 
-@app.post("/toggle_lock/{account_index}")
-async def toggle_lock(account_index: int, session_id: Optional[str] = Cookie(None)):
+@app.post("/toggle_lock/{account_id}")
+async def toggle_lock(account_id: int, session_id: Optional[str] = Cookie(None)):
     session = get_session(session_id)
     if not session:
         raise HTTPException(status_code=403, detail="未登录")
 
-    accounts = db.get_all_accounts()
-    if account_index < 0 or account_index >= len(accounts):
-        raise HTTPException(status_code=404, detail="账户不存在")
-
-    account = accounts[account_index]
+    account = find_account(account_id)
 
     # 只有管理人才能锁定/解锁
     if account['manager'] != session.username:
         raise HTTPException(status_code=403, detail="只能操作自己的账户")
 
     new_lock_state = not account['locked']
-    db.toggle_lock(account_index, new_lock_state)
+    db.toggle_lock(account_id, new_lock_state)
     return RedirectResponse(url="/", status_code=303)
 
 
-@app.post("/delete_account/{account_index}")
-async def delete_account(account_index: int, session_id: Optional[str] = Cookie(None)):
+@app.post("/delete_account/{account_id}")
+async def delete_account(account_id: int, session_id: Optional[str] = Cookie(None)):
     session = get_session(session_id)
     if not session:
         raise HTTPException(status_code=403, detail="未登录")
 
-    accounts = db.get_all_accounts()
-    if account_index < 0 or account_index >= len(accounts):
-        raise HTTPException(status_code=404, detail="账户不存在")
-
-    account = accounts[account_index]
+    account = find_account(account_id)
 
     # 只有管理人才能删除
     if account['manager'] != session.username and not session.is_viewer:
         raise HTTPException(status_code=403, detail="只能删除自己的账户")
 
-    db.delete_account(account_index)
+    db.delete_account(account_id)
     return RedirectResponse(url="/", status_code=303)
 
 
 
 
+# 映射是静态的，启动时就把每个编码的响应编码好，查询时直接返回
+_NAME_RESPONSES = {
+    code: ORJSONResponse({"account_name": name})
+    for code, name in ACCOUNT_MAPPING.items()
+}
+
+
 @app.get("/get_account_name/{account_code}")
 async def get_account_name(account_code: str):
-    if account_code in ACCOUNT_MAPPING:
-        return {"account_name": ACCOUNT_MAPPING[account_code]}
-    else:
+    response = _NAME_RESPONSES.get(account_code)
+    if response is None:
         raise HTTPException(status_code=404, detail="账户编码不存在")
+    return response
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # 会话存在进程内存里（msgpack文件只是本进程的快照），多worker会互相
+    # 认不了对方的session_id，登出也只对本进程生效；会话迁入共享存储前
+    # 必须保持单worker
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=1,
+    )